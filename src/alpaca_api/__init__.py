@@ -1 +1 @@
-from .download import AlpacaRequester
\ No newline at end of file
+from .download import AlpacaRequester, CachePolicy, TokenBucket
\ No newline at end of file
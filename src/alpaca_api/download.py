@@ -1,35 +1,492 @@
+import atexit
+import csv
+import functools
+import hashlib
+import io
 import logging
 import os
+import platform
+import queue
+import re
+import threading
 import time
 from collections.abc import Iterable
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Any, Callable, Dict, Optional, Set, TypeVar
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+from urllib.parse import quote, urlencode
 
+import ijson
+import orjson
 import pandas as pd
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from rich.logging import RichHandler
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+try:
+    import liburing
+except ImportError:  # only needed for io_uring writes
+    liburing = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for parquet output
+    pa = pq = None
 
 T = TypeVar('T')
+Rows = List[Dict[str,Any]]
 
 logger = logging.getLogger("alpaca_api")
 logger.addHandler(logging.NullHandler())
 
+# Writes log records to the log file from a background thread, so logging
+# from the download loop only costs a queue put
+_log_listener: Optional[QueueListener] = None
+
+def _stop_log_listener() -> None:
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()  # flushes anything still queued
+        for h in _log_listener.handlers:
+            h.close()
+        _log_listener = None
+
+def _flush_log_listener() -> None:
+    if _log_listener is not None:
+        # stop() only returns once the queue has been drained
+        _log_listener.stop()
+        _log_listener.start()
+
+atexit.register(_stop_log_listener)
+
 NEWS_BASE_URL = "https://data.alpaca.markets/v1beta1/news"
 BARS_BASE_URL = "https://data.alpaca.markets/v2/stocks/bars"
 CALENDAR_BASE_URL = "https://paper-api.alpaca.markets/v2/calendar"
 
+# Bars have a fixed schema, so there's no need for pandas to infer it
+BARS_DTYPES = {
+    't': 'datetime64[ns, UTC]',
+    'o': 'float64',
+    'h': 'float64',
+    'l': 'float64',
+    'c': 'float64',
+    'v': 'int64',
+    'n': 'int64',
+    'vw': 'float64',
+}
+
+CACHE_TTL_RECENT = 15 * 60  # seconds before a cached response for a still-open period expires
+STREAM_MIN_BYTES = 1 << 20  # responses at least this large (as sent) are parsed while they download
+FLUSH_ROWS = 50_000  # rows buffered across a download's files before they are written to disk
+WRITE_CHUNK_SIZE = 1 << 16  # bytes of CSV text handed to each os.write call
+
+class CachePolicy(str, Enum):
+    """
+    How AlpacaRequester uses its on-disk response cache.
+
+    - ENABLED: serve fresh cached responses, cache everything fetched
+    - READ_ONLY: serve fresh cached responses, never write to the cache
+    - REPLAY: serve cached responses regardless of age, never hit the API
+    - DISABLED: always hit the API (the default)
+    """
+    ENABLED = "enabled"
+    READ_ONLY = "read_only"
+    REPLAY = "replay"
+    DISABLED = "disabled"
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that spreads requests evenly over the API's
+    rate-limit window instead of bursting until the limit is hit.
+    """
+    def __init__(self, rate_limit: int, tokens: Optional[float] = None, period: float = 60.0) -> None:
+        self.capacity = float(rate_limit)
+        self.rate = rate_limit / period  # tokens per second
+        self.tokens = self.capacity if tokens is None else min(float(tokens), self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: int = 1) -> float:
+        """
+        Take n tokens, sleeping until they are available. Returns the time
+        spent waiting in seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait_time = max(0.0, (n - self.tokens) / self.rate)
+            # Reserve the tokens now so concurrent callers queue up behind us
+            self.tokens -= n
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+class _TeeReader:
+    """
+    File-like wrapper that copies everything read from a stream into a second
+    file, so a response can be parsed and cached in a single pass. The first
+    and last few KiB read are kept, for fields outside the part of the body
+    that is parsed incrementally.
+    """
+    KEEP = 4096
+
+    def __init__(self, raw: Any, copy: Optional[BinaryIO]) -> None:
+        self.raw = raw
+        self.copy = copy
+        self.head = b''
+        self.tail = b''
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        if self.copy is not None:
+            self.copy.write(data)
+        if len(self.head) < self.KEEP:
+            self.head += data[:self.KEEP - len(self.head)]
+        self.tail = (self.tail + data)[-self.KEEP:]
+        return data
+
+_NEXT_PAGE_TOKEN = re.compile(rb'"next_page_token"\s*:\s*(null|"(?:[^"\\]|\\.)*")')
+
+def _parse_streamed(raw: Any, key: str) -> Dict[str,Any]:
+    """
+    Incrementally parse a JSON object of the form {key: {...},
+    "next_page_token": ...} from a file-like object, building body[key]
+    entry by entry as bytes arrive instead of holding the whole response in
+    memory first.
+    """
+    reader = raw if isinstance(raw, _TeeReader) else _TeeReader(raw, None)
+    # Letting ijson walk the stream itself keeps the parsing in its C backend
+    body: Dict[str,Any] = {key: dict(ijson.kvitems(reader, key, use_float=True))}
+    while reader.read(1 << 16):
+        pass  # the rest of the body, so that the cached copy is complete
+
+    # The token is a short top-level field next to body[key], so it is in the
+    # bytes kept at either end of the body
+    match = _NEXT_PAGE_TOKEN.search(reader.tail) or _NEXT_PAGE_TOKEN.search(reader.head)
+    if match is None:
+        raise ValueError("Response has no next_page_token next to its data")
+    body['next_page_token'] = orjson.loads(match.group(1))
+    return body
+
+class _CsvFile:
+    """
+    An append-only CSV file descriptor that stays open for the duration of a
+    download, so that batches of rows are streamed to it without reopening
+    the file each time.
+    """
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.fieldnames: Optional[List[str]] = None
+        if os.fstat(self.fd).st_size > 0:
+            # Appended rows have to line up with the existing header
+            with open(path, newline='') as f:
+                self.fieldnames = next(csv.reader(f), None)
+
+    def write(self, rows: Rows) -> None:
+        for chunk in self._chunks(rows):
+            self.write_bytes(chunk.encode())
+
+    def encode(self, rows: Rows) -> bytes:
+        """
+        The bytes that write(rows) would append, for callers that do the
+        writing themselves.
+        """
+        return "".join(self._chunks(rows)).encode()
+
+    def _chunks(self, rows: Rows) -> Iterator[str]:
+        if not rows:
+            return
+
+        buffer = io.StringIO(newline='')
+        if self.fieldnames is None:
+            self.fieldnames = list(dict.fromkeys(k for row in rows for k in row))
+            csv.writer(buffer, lineterminator='\n').writerow(self.fieldnames)
+        writer = csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore', lineterminator='\n')
+
+        for start in range(0, len(rows), 512):
+            writer.writerows(rows[start:start+512])
+            if buffer.tell() >= WRITE_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def write_bytes(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class _ParquetFile:
+    """
+    A parquet file whose writer stays open for the duration of a download,
+    so that each batch of rows is appended as a new row group.
+
+    Rows are written to <path>.tmp, which only replaces the file at path
+    once the download is complete, so a failed download leaves the
+    previous file intact.
+    """
+    def __init__(self, path: Path, dtypes: Optional[Dict[str,str]] = None) -> None:
+        if pa is None:
+            raise ImportError("Writing parquet files requires pyarrow, install it with `pip install pyarrow`")
+        self.path = path
+        self.tmp_path = path.with_name(f"{path.name}.tmp")
+        self.writer: Optional[pq.ParquetWriter] = None
+        # Columns with a known type are cast to it, the rest are inferred
+        self.known = pa.Schema.from_pandas(
+            pd.DataFrame({k: pd.Series(dtype=v) for k, v in (dtypes or {}).items()}),
+            preserve_index=False,
+        ).remove_metadata()
+
+    def write(self, rows: Rows) -> None:
+        if not rows:
+            return
+
+        table = pa.Table.from_pylist(rows)
+        if self.writer is None:
+            schema = pa.schema([
+                self.known.field(name) if name in self.known.names else table.schema.field(name)
+                for name in table.column_names
+            ])
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, schema, compression='zstd', use_dictionary=True)
+        self.writer.write_table(table.select(self.writer.schema.names).cast(self.writer.schema))
+
+    def close(self, complete: bool = False) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if complete:
+                os.replace(self.tmp_path, self.path)
+        self.tmp_path.unlink(missing_ok=True)
+
+def _count_rows(path: Path, offset: int = 0) -> int:
+    """
+    The number of rows in a CSV file after its first offset bytes, not
+    counting the header. Counts newlines unless there are quoted fields,
+    which may contain newlines themselves and need to be parsed.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        newlines = 0
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            if b'"' in chunk:
+                break
+            newlines += chunk.count(b'\n')
+        else:
+            return max(newlines - (offset == 0), 0)
+        f.seek(offset)
+        rows = sum(1 for _ in csv.reader(io.TextIOWrapper(f, newline='')))
+    return max(rows - (offset == 0), 0)
+
+class _PagedOutput:
+    """
+    One output file of a paginated download. Rows are buffered and flushed
+    to the data file in large batches, and the url and next_page_token of
+    every page are recorded once per page in a sidecar index
+    (<path>.pages.csv) instead of being repeated on every row.
+
+    Each page also records when the download that fetched it started
+    (run_started), which tells runs apart in indexes that several
+    downloads have appended to, and for CSV files the size of the data file
+    once its rows were written (end_offset).
+    """
+    INDEX_FIELDS = ['page_idx', 'url', 'next_page_token', 'start_row', 'end_row', 'run_started', 'end_offset']
+
+    def __init__(
+            self,
+            path: Path,
+            format: str,
+            dtypes: Optional[Dict[str,str]],
+            store_index: bool = True,
+            run_started: Optional[str] = None,
+        ) -> None:
+        self.data = _CsvFile(path) if format == "csv" else _ParquetFile(path, dtypes)
+        self.index_path = Path(f"{path}.pages.csv") if store_index else None
+        self.final_index_path: Optional[Path] = None
+        self.run_started = run_started or datetime.now(timezone.utc).isoformat(timespec='microseconds')
+        self.rows: Rows = []
+        self.pages: List[List[Any]] = []
+        self.next_page_idx = 0
+        self.num_rows = 0  # rows in the data file, including buffered ones
+        self.size = os.fstat(self.data.fd).st_size if format == "csv" else 0  # bytes written to the data file
+
+        if self.index_path is None:
+            return
+        if format == "csv":
+            # Continue the row and page numbering of an existing file. A run that
+            # died between writing rows and recording their pages leaves rows
+            # the index doesn't know about, so the rows past the last recorded
+            # offset are counted too.
+            last_page = AlpacaRequester.last_page(self.index_path)
+            if last_page is None or int(last_page['end_offset']) > self.size:
+                self.num_rows = _count_rows(path)
+            else:
+                self.next_page_idx = int(last_page['page_idx']) + 1
+                self.num_rows = int(last_page['end_row']) + _count_rows(path, int(last_page['end_offset']))
+                if self.num_rows != int(last_page['end_row']):
+                    logger.warning(
+                        "%s has %s rows but its page index only covers %s, the rest have no page recorded",
+                        path, self.num_rows, last_page['end_row'],
+                    )
+        else:
+            # Parquet files are rewritten, so their index is too, and it is
+            # swapped in along with the data file
+            self.final_index_path = self.index_path
+            self.index_path = Path(f"{self.final_index_path}.tmp")
+            self.index_path.unlink(missing_ok=True)
+
+    def add_page(self, rows: Rows, url: Optional[str], next_page_token: Optional[str]) -> None:
+        self.rows.extend(rows)
+        self.pages.append([
+            self.next_page_idx, url, next_page_token, self.num_rows, self.num_rows + len(rows), self.run_started, None,
+        ])
+        self.next_page_idx += 1
+        self.num_rows += len(rows)
+
+    def encode_rows(self) -> bytes:
+        """
+        Take the buffered rows of a CSV file as the bytes to append to it,
+        recording in each of their pages where its rows end in the file.
+        """
+        chunks = []
+        start = 0
+        for page in self.pages:
+            if page[-1] is None:
+                end = start + page[4] - page[3]
+                chunks.append(self.data.encode(self.rows[start:end]))
+                self.size += len(chunks[-1])
+                page[-1] = self.size
+                start = end
+        self.rows = []
+        return b"".join(chunks)
+
+    def flush(self) -> None:
+        # Rows go to disk before the pages that reference them
+        if isinstance(self.data, _CsvFile):
+            self.data.write_bytes(self.encode_rows())
+        else:
+            self.data.write(self.rows)
+            self.rows = []
+        if self.index_path is not None and self.pages:
+            is_new = not self.index_path.is_file() or self.index_path.stat().st_size == 0
+            with open(self.index_path, 'a', newline='') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                if is_new:
+                    writer.writerow(self.INDEX_FIELDS)
+                writer.writerows(self.pages)
+        self.pages = []
+
+    def close(self, complete: bool = False) -> None:
+        """
+        Close the data file. complete says whether the download finished,
+        which is when a rewritten (parquet) file and its index replace the
+        previous ones; otherwise they are discarded.
+        """
+        if isinstance(self.data, _ParquetFile):
+            self.data.close(complete)
+        else:
+            self.data.close()
+        if self.final_index_path is not None:
+            if complete and self.index_path.is_file():
+                os.replace(self.index_path, self.final_index_path)
+            self.index_path.unlink(missing_ok=True)
+
+class _Uring:
+    """
+    Writes a batch of buffers to several files with a single io_uring
+    submission instead of one write syscall per file (Linux only, requires
+    the optional liburing package).
+    """
+    def __init__(self, entries: int = 256) -> None:
+        self.entries = entries
+        self.ring = liburing.Ring()
+        self.cqe = liburing.Cqe()
+        liburing.io_uring_queue_init(entries, self.ring)
+
+    @staticmethod
+    def create() -> Optional["_Uring"]:
+        """
+        A new ring, or None (after logging why) if io_uring can't be used
+        here, in which case callers fall back to plain writes.
+        """
+        if platform.system() != "Linux" or liburing is None:
+            logger.warning("io_uring writes need Linux and the liburing package, falling back to regular writes")
+            return None
+        try:
+            return _Uring()
+        except OSError as e:  # e.g. kernels older than 5.1, or io_uring disabled
+            logger.warning("Could not set up io_uring (%s), falling back to regular writes", e)
+            return None
+
+    def write_all(self, writes: List[Tuple[int,bytes]]) -> None:
+        """
+        Append each buffer to its file descriptor (opened with O_APPEND). At
+        most one buffer per descriptor, so that their order doesn't matter.
+        """
+        pending = [(fd, data) for fd, data in writes if data]
+        while pending:
+            batch, pending = pending[:self.entries], pending[self.entries:]
+            for i, (fd, data) in enumerate(batch):
+                sqe = liburing.io_uring_get_sqe(self.ring)
+                liburing.io_uring_prep_write(sqe, fd, data)
+                liburing.io_uring_sqe_set_data64(sqe, i)
+            liburing.io_uring_submit_and_wait(self.ring, len(batch))
+
+            written = [0] * len(batch)
+            for _ in batch:
+                liburing.io_uring_wait_cqe(self.ring, self.cqe)
+                cqe = self.cqe[0]
+                written[cqe.user_data] = liburing.trap_error(cqe.res)
+                liburing.io_uring_cqe_seen(self.ring, cqe)
+
+            # Resubmit whatever was only partially written
+            pending += [(fd, data[n:]) for (fd, data), n in zip(batch, written) if n < len(data)]
+
+    def close(self) -> None:
+        liburing.io_uring_queue_exit(self.ring)
+
+def _flush_outputs(outputs: Iterable[_PagedOutput], ring: Optional[_Uring]) -> None:
+    """
+    Flush several outputs, submitting all of their CSV data in one go when
+    an io_uring is available.
+    """
+    outputs = list(outputs)
+    if ring is not None:
+        ring.write_all([(o.data.fd, o.encode_rows()) for o in outputs if isinstance(o.data, _CsvFile)])
+    for o in outputs:
+        o.flush()  # writes the page index, and any rows not written above
+
 class AlpacaRequester:
     api_key: str
     api_secret: str
     headers: Dict[str,str]
+    session: requests.Session
     pbars: Set[tqdm]
+    files: Dict[str,_PagedOutput]
+    cache_dir: Path
+    cache_policy: CachePolicy
+    bucket: Optional[TokenBucket]
 
     def __init__(self,
             api_key:Optional[str]=None,
             api_secret:Optional[str]=None,
+            cache_dir:Optional[str]=None,
+            cache_policy:CachePolicy|str=CachePolicy.DISABLED,
         ) -> None:
         if api_key is None or api_secret is None:
             if load_dotenv():
@@ -49,25 +506,69 @@ class AlpacaRequester:
             "APCA-API-SECRET-KEY": api_secret
         }
 
+        # Reuse connections across pages instead of paying for a new TCP+TLS
+        # handshake on every request
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.cache_dir = Path(cache_dir or "~/.cache/alpaca_api").expanduser()
+        self.cache_policy = CachePolicy(cache_policy)
+        # Created once the first response reveals the account's rate limit
+        self.bucket = None
+        self._bucket_lock = threading.Lock()
+
         self.pbars = set()
+        self.files = {}
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "AlpacaRequester":
+        return self
 
-    def close_pbars(self) -> None:
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close_resources(self) -> None:
         for pbar in self.pbars:
             pbar.close()
         self.pbars.clear()
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+    @contextmanager
+    def _managed(self) -> Iterator[None]:
+        """
+        Release everything a download can leave behind, whether it finished
+        or failed: progress bars, open output files and writers, and log
+        records still waiting to be written.
+        """
+        try:
+            yield
+        finally:
+            logger.debug("Closing progress bars and files")
+            self.close_resources()
+            _flush_log_listener()
 
     @staticmethod
     def close_pbar_on_exception(func: Callable[...,T]) -> Callable[...,T]:
+        @functools.wraps(func)
         def wrapper(self, *args, **kwargs) -> T:
-            try:
-                output = func(self, *args, **kwargs)
-                logging.getLogger("alpaca_api").debug("Closing progress bars")
-                self.close_pbars()
-                return output
-            except BaseException:
-                logging.getLogger("alpaca_api").debug("Closing progress bars")
-                self.close_pbars()
-                raise
+            with self._managed():
+                return func(self, *args, **kwargs)
         return wrapper
     
     @staticmethod
@@ -79,6 +580,8 @@ class AlpacaRequester:
         """
         Configure and return the library-scoped logger ("alpaca_api").
         """
+        global _log_listener
+
         logger = logging.getLogger("alpaca_api")
         logger.setLevel(level)
         logger.propagate = False  # don't spam the root logger
@@ -86,6 +589,7 @@ class AlpacaRequester:
         # Clear existing handlers so we don't duplicate logs on repeated calls
         for h in list(logger.handlers):
             logger.removeHandler(h)
+        _stop_log_listener()
 
         if logfile_path is None:
             logfile_path = f"logs/request_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.log"
@@ -97,139 +601,475 @@ class AlpacaRequester:
             "%(asctime)s [%(name)s] [%(levelname)s] %(message)s", datefmt="[%X]"
         )
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+
+        log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+        logger.addHandler(QueueHandler(log_queue))
+        _log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _log_listener.start()
 
         if to_console:
             logger.addHandler(RichHandler())
 
         return logger
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _encode_params(items: Tuple[Tuple[str,Any],...]) -> str:
+        return urlencode(
+            [(k, ",".join(str(v1) for v1 in v) if isinstance(v, tuple) else v) for k, v in items],
+            quote_via=quote,
+        )
+
     @staticmethod
     def make_url(base:str, **kwargs:Any) -> str:
         if not kwargs:
             return base
-        
-        params = []
-        for k, v in kwargs.items():
-            if isinstance(v, Iterable) and not isinstance(v, (str, bytes, bytearray)):
-                joined = "%2C".join(str(v1) for v1 in v)
-                params.append(f"{k}={joined}")
-            else:
-                params.append(f"{k}={v}")
 
-        final = f"{base}?{'&'.join(params)}"
-        return final
+        # Parameters are sorted so that the same request always produces the
+        # same URL (and so hits the same cache entries)
+        items = tuple(sorted(
+            (k, tuple(v) if isinstance(v, Iterable) and not isinstance(v, (str, bytes, bytearray)) else v)
+            for k, v in kwargs.items()
+        ))
+        return f"{base}?{AlpacaRequester._encode_params(items)}"
+
+    @staticmethod
+    def last_page(index_path: str|Path) -> Optional[Dict[str,str]]:
+        """
+        The last page recorded in a page index, or None if there is none.
+        Only the header and the end of the file are read.
+        """
+        try:
+            with open(index_path, 'rb') as f:
+                header = f.readline()
+                size = f.seek(0, os.SEEK_END)
+                block = 4096
+                while True:
+                    start = max(len(header), size - block)
+                    f.seek(start)
+                    tail = f.read().rstrip(b'\r\n')
+                    if b'\n' in tail or start == len(header):
+                        break
+                    block *= 2  # last line longer than the block, read more
+        except FileNotFoundError:
+            return None
+
+        last = tail.rsplit(b'\n', 1)[-1]
+        if not last:
+            return None
+        fieldnames, values = csv.reader([header.decode(), last.decode()])
+        return dict(zip(fieldnames, values))
+
+    @staticmethod
+    def resume_token(base_url: str, index_paths: Iterable[str|Path]) -> Optional[str]:
+        """
+        Where to resume a request for base_url whose pages were written to
+        files with the given page indexes, listed in the order the API
+        returns their rows (e.g. sorted by symbol for bars). Returns the
+        next_page_token of the last page recorded for this request by its
+        most recent run, "" if that run wrote its final page, or None if no
+        page of this request has been recorded.
+        """
+        page_url_prefix = AlpacaRequester._page_url_prefix(base_url)
+        latest: Optional[Tuple[str,str]] = None  # (run_started, next_page_token)
+        for index_path in index_paths:
+            page = AlpacaRequester.last_page(index_path)
+            if page is None or not (page['url'] == base_url or page['url'].startswith(page_url_prefix)):
+                continue
+            # Indexes are appended to by every run, so a file the latest run
+            # never reached still ends with an earlier run's pages. Pages of
+            # the same run go to later files as the download progresses.
+            if latest is None or page['run_started'] >= latest[0]:
+                latest = (page['run_started'], page['next_page_token'])
+        return None if latest is None else latest[1]
+
+    @staticmethod
+    def _page_url_prefix(base_url: str) -> str:
+        return f"{base_url}{'&' if '?' in base_url else '?'}page_token="
+
+    @staticmethod
+    def join_pages(path: str) -> pd.DataFrame:
+        """
+        Load a file written by paginate together with the url and
+        next_page_token of the page each row came from.
+        """
+        df = pd.read_parquet(path) if str(path).endswith(".parquet") else pd.read_csv(path)
+        pages = pd.read_csv(f"{path}.pages.csv", dtype={'url': str, 'next_page_token': str}, keep_default_na=False)
+        counts = pages['end_row'] - pages['start_row']
+        per_row = pages.loc[pages.index.repeat(counts), ['url', 'next_page_token']]
+        # Number each page's rows from its start_row onwards
+        per_row.index = (
+            pages['start_row'].repeat(counts).to_numpy() + per_row.groupby(level=0).cumcount().to_numpy()
+        )
+        # Files written before the page index existed carry these columns on
+        # each row, and keep them for the rows appended since
+        legacy = [c for c in ('url', 'next_page_token') if c in df.columns]
+        if legacy:
+            per_row = per_row.combine_first(df[legacy])
+            df = df.drop(columns=legacy)
+        return df.join(per_row)
+
+    @staticmethod
+    def cache_ttl(api_options: Dict[str,Any]) -> Optional[float]:
+        """
+        How long a cached response for a request with these options stays
+        valid, in seconds. Requests for a period that ended before today can
+        no longer change, so they never expire (None).
+        """
+        end = api_options.get("end")
+        if end is None:
+            return CACHE_TTL_RECENT
+        try:
+            end = datetime.fromisoformat(str(end).replace("Z", "+00:00"))
+        except ValueError:
+            return CACHE_TTL_RECENT
+        if end.tzinfo is None:
+            end = end.replace(tzinfo=timezone.utc)
+        if end < datetime.now(timezone.utc) - timedelta(days=1):
+            return None
+        return CACHE_TTL_RECENT
+
+    def _cache_path(self, url: str) -> Path:
+        key = hashlib.sha256(f"GET {url}".encode()).hexdigest()
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _read_cache(self, url: str, ttl: Optional[float]) -> Optional[bytes]:
+        if self.cache_policy == CachePolicy.DISABLED:
+            return None
+        path = self._cache_path(url)
+        try:
+            if (
+                self.cache_policy != CachePolicy.REPLAY
+                and ttl is not None
+                and path.stat().st_mtime < time.time() - ttl
+            ):
+                return None
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def _cache_writer(self, url: str) -> Iterator[Optional[BinaryIO]]:
+        """
+        Yield a file to write the response for url into, or None if the
+        cache policy doesn't allow writing.
+        """
+        if self.cache_policy != CachePolicy.ENABLED:
+            yield None
+            return
+        path = self._cache_path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so that a crash never leaves a truncated entry
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, 'wb') as f:
+                yield f
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def _get_json(self, url: str, ttl: Optional[float] = CACHE_TTL_RECENT, stream_key: Optional[str] = None) -> Any:
+        """
+        Fetch and decode a JSON response, going through the response cache.
+        Retries while rate limited and raises a ValueError on any other
+        unsuccessful status code.
+
+        If stream_key is given and the response is large, body[stream_key]
+        is parsed incrementally while the response downloads.
+        """
+        content = self._read_cache(url, ttl)
+        if content is not None:
+            logger.info("Using cached response for %s", url)
+            return orjson.loads(content)
+        if self.cache_policy == CachePolicy.REPLAY:
+            raise ValueError(f"No cached response for {url} and cache policy is {self.cache_policy.value}")
+
+        while True:
+            if self.bucket is not None:
+                waited = self.bucket.acquire()
+                if waited > 0:
+                    logger.info("Throttled for %.2f seconds to stay under the rate limit", waited)
+
+            logger.info("Requesting data from %s", url)
+            response = self.session.get(url, stream=True)
+            if response.status_code == 200:
+                break
+
+            # Release the streamed connection back to the pool on every way out
+            with response:
+                if response.status_code == 429:
+                    logger.error("Error Status Code %s: Rate limit exceeded. Waiting for 5 seconds and retrying...", response.status_code)
+                elif response.status_code == 403:
+                    raise ValueError(
+                        f"Error Status Code {response.status_code}: Authentication headers are missing or invalid. Make sure you authenticate your request with valid API credentials."
+                    )
+                elif response.status_code >= 500 and self.cache_policy != CachePolicy.DISABLED and self._cache_path(url).is_file():
+                    logger.warning("Error Status Code %s: serving stale cached response for %s", response.status_code, url)
+                    return orjson.loads(self._cache_path(url).read_bytes())
+                else:
+                    raise ValueError(f"Error Status Code {response.status_code}: {response.text}")
+            time.sleep(5)
+
+        # Logging takes the raw header strings, they only need parsing once
+        # to size the token bucket
+        rate_limit = response.headers.get("X-RateLimit-Limit")
+        if rate_limit is not None:
+            rate_limit_remaining = response.headers.get("X-RateLimit-Remaining")
+            logger.info("Rate limit remaining: %s/%s", rate_limit_remaining, rate_limit)
+            if self.bucket is None:
+                with self._bucket_lock:
+                    if self.bucket is None:
+                        self.bucket = TokenBucket(int(rate_limit), tokens=int(rate_limit_remaining or 0))
+
+        with response, self._cache_writer(url) as cache_file:
+            if stream_key is not None and int(response.headers.get("Content-Length", 0)) >= STREAM_MIN_BYTES:
+                response.raw.decode_content = True
+                return _parse_streamed(_TeeReader(response.raw, cache_file), stream_key)
+            if cache_file is not None:
+                cache_file.write(response.content)
+            return orjson.loads(response.content)
 
     def paginate(
             self,
             base: str,
             api_options: Dict[str,Any],
-            data_fmt: Callable[[Dict],Dict[str,pd.DataFrame]],
+            data_fmt: Callable[[Dict],Dict[str,Rows]],
             write_path: str,
-            logfile_path: str,
-            log_fmt: Optional[Callable[[Dict[str,pd.DataFrame]], str]] = None,
+            logfile_path: Optional[str],
+            log_fmt: Optional[Callable[[str,Rows], str]] = None,
             verbose: bool = False,
             store_url=True,
             store_token=True,
+            desc: str = "Fetching pages",
+            format: str = "csv",
+            dtypes: Optional[Dict[str,str]] = None,
+            stream_key: Optional[str] = None,
+            use_uring: bool = False,
+            cancel: Optional[threading.Event] = None,
         ) -> None:
+        """
+        Fetch every page of a request and write its rows to disk. Pass
+        logfile_path=None if logging has already been configured, e.g. when
+        several paginate calls run concurrently.
 
-        logger = AlpacaRequester.configure_logging(
-            level=logging.INFO,
-            logfile_path=logfile_path,
-            to_console=verbose,
-        )
-        logger.info(f"Logging to {logfile_path}")
+        Unless both store_url and store_token are False, the url and
+        next_page_token of each page are recorded in <file>.pages.csv next
+        to each output file; see join_pages.
+
+        format is either "csv", which appends to existing files, or
+        "parquet", which replaces each file once every page has been fetched
+        (leaving it untouched if the download fails), writing one row group
+        per batch and casting the columns listed in dtypes to those types. stream_key
+        names the field of large response bodies to parse incrementally.
+        log_fmt(name, rows) summarises the rows of a page written to one
+        file, for the log.
 
-        pbar = tqdm(total=0, desc="Fetching pages")
+        With use_uring=True, the CSV rows buffered for all output files are
+        written with one io_uring submission per flush rather than one
+        write per file (Linux only, requires liburing). Falls back to
+        regular writes where io_uring isn't available.
+
+        If cancel is set while pages are being fetched, paginate stops after
+        the current page, keeping what has been written so far.
+        """
+        if format not in ("csv", "parquet"):
+            raise ValueError(f"Unsupported format {format!r}, expected 'csv' or 'parquet'")
+
+        if logfile_path is not None:
+            AlpacaRequester.configure_logging(
+                level=logging.INFO,
+                logfile_path=logfile_path,
+                to_console=verbose,
+            )
+            logger.info("Logging to %s", logfile_path)
+
+        pbar = tqdm(total=0, desc=desc)
         self.pbars.add(pbar)
 
         next_page_token = api_options.pop("page_token", None)
         base_url = self.make_url(base,**api_options)
-        url = base_url if next_page_token is None else f"{base_url}&page_token={next_page_token}"
+        page_url_prefix = self._page_url_prefix(base_url)
+        url = base_url if next_page_token is None else page_url_prefix + quote(next_page_token, safe='')
         num_pages = 0
+        ttl = self.cache_ttl(api_options)
 
-        while True:
-            logger.info("--------------------------------")
-            logger.info(f"Requesting data from {url}")
-            response = requests.get(url, headers=self.headers)
+        outputs: Dict[str,_PagedOutput] = {}
+        complete = False
+        run_started = datetime.now(timezone.utc).isoformat(timespec='microseconds')
+        ring = _Uring.create() if use_uring else None
+        try:
+            # Pages form a chain (each body holds the token for the next one), so
+            # the most we can overlap is fetching page n+1 while page n is being
+            # parsed and written to disk.
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                pending = prefetcher.submit(self._get_json, url, ttl, stream_key)
 
-            if response.status_code == 429:
-                logger.error(f"Error Status Code {response.status_code}: Rate limit exceeded. Waiting for 5 seconds and retrying...")
-                time.sleep(5)
-                continue
-            elif response.status_code == 403:
-                raise ValueError(
-                    f"Error Status Code {response.status_code}: Authentication headers are missing or invalid. Make sure you authenticate your request with valid API credentials."
-                )
-            elif response.status_code != 200:
-                raise ValueError(f"Error Status Code {response.status_code}: {response.text}")
-
-            if num_pages == 0:
-                logger.info(f"Initial request successful, status code: {response.status_code}")
-            num_pages += 1
-            pbar.update(1)
-
-            rate_limit = int(response.headers["X-RateLimit-Limit"])
-            rate_limit_remaining = int(response.headers["X-RateLimit-Remaining"])
-            logger.info(f"Rate limit remaining: {rate_limit_remaining}/{rate_limit}")
-
-            body = response.json()
-            next_page_token = body["next_page_token"]
-
-            tables = data_fmt(body)
-            for name,df in tables.items():
-                path = Path(write_path.format(name))
-                path.parent.mkdir(parents=True, exist_ok=True)
-                has_rows = path.is_file() and path.stat().st_size > 0
-                if store_url:
-                    df['url'] = url
-                if store_token:
-                    df['next_page_token'] = next_page_token
-                df.to_csv(
-                    path,
-                    mode = 'a' if has_rows else 'w',
-                    header = not has_rows,
-                    index = False
-                )
-                has_rows = True
+                while True:
+                    logger.info("--------------------------------")
+                    body = pending.result()
 
-            if log_fmt is not None:
-                logger.info(log_fmt(tables))
+                    if num_pages == 0:
+                        logger.info("Initial request successful")
+                    num_pages += 1
+                    pbar.update(1)
 
-            if next_page_token is None:
-                logger.info("Finished fetching pages")
-                break
+                    next_page_token = body["next_page_token"]
+
+                    if next_page_token is not None:
+                        next_url = page_url_prefix + quote(next_page_token, safe='')
+                        pending = prefetcher.submit(self._get_json, next_url, ttl, stream_key)
+
+                    tables = data_fmt(body)
+                    for name,rows in tables.items():
+                        if name not in outputs:
+                            path = write_path.format(name)
+                            outputs[name] = self.files[path] = _PagedOutput(
+                                Path(path), format, dtypes, store_index=store_url or store_token, run_started=run_started,
+                            )
+                        outputs[name].add_page(
+                            rows,
+                            url if store_url else None,
+                            next_page_token if store_token else None,
+                        )
+                    # Buffered rows are held as dicts, so the budget covers all
+                    # files at once. They are flushed together so that what is on
+                    # disk always ends at the same page, which is what get_bars
+                    # resumes from.
+                    if sum(len(o.rows) for o in outputs.values()) >= FLUSH_ROWS:
+                        _flush_outputs(outputs.values(), ring)
 
-            if rate_limit_remaining == 0:
-                rate_limit_reset = int(response.headers["X-RateLimit-Reset"])
-                to_wait = (rate_limit_reset - time.time()) * 0.5
-                logger.info(f"Rate limit reached, waiting for {to_wait} seconds")
-                time.sleep(to_wait)
+                    # The summary can be long, only build it if it will be written
+                    if log_fmt is not None and logger.isEnabledFor(logging.INFO):
+                        logger.info("\n".join(log_fmt(name, rows) for name, rows in tables.items() if rows))
 
-            url = f"{base_url}&page_token={next_page_token}"
+                    if next_page_token is None:
+                        logger.info("Finished fetching pages")
+                        complete = True
+                        break
+                    if cancel is not None and cancel.is_set():
+                        logger.warning("Cancelled after %s pages", num_pages)
+                        break
+
+                    url = next_url
+        finally:
+            try:
+                _flush_outputs(outputs.values(), ring)
+            except BaseException:
+                complete = False
+                raise
+            finally:
+                for name,output in outputs.items():
+                    self.files.pop(write_path.format(name), None)
+                    output.close(complete)
+                if ring is not None:
+                    ring.close()
 
         pbar.close()
         self.pbars.discard(pbar)
 
+    @staticmethod
+    def split_symbols(symbols: str|Iterable[str]) -> List[str]:
+        """
+        Flatten symbols given as a comma-separated string and/or a list of
+        them, e.g. ["SPY,AAPL", "NVDA"] -> ["SPY", "AAPL", "NVDA"]. Repeated
+        symbols are dropped, since two shards must never write the same file.
+        """
+        if isinstance(symbols, str):
+            symbols = [symbols]
+        return list(dict.fromkeys(s.strip() for group in symbols for s in group.split(",") if s.strip()))
+
     @close_pbar_on_exception
-    def get_bars(self,verbose=False,write_path="bars/{}.csv",store_url=True,store_token=True,**kwargs) -> None:
+    def get_bars(self,verbose=False,write_path=None,store_url=True,store_token=True,shard_size=10,max_workers=8,format="csv",use_uring=False,resume=False,**kwargs) -> None:
         """
         https://docs.alpaca.markets/reference/stockbars
+
+        Symbols are split into shards of at most shard_size symbols, and up
+        to max_workers shards are paginated concurrently. All shards share
+        the same connection pool and rate limiter.
+
+        Bars are written to "bars/{symbol}.csv" by default, or to
+        "bars/{symbol}.parquet" with format="parquet" (requires pyarrow).
+        use_uring=True batches each shard's CSV writes through io_uring
+        (Linux only, requires liburing); see paginate.
+
+        With resume=True, a shard whose earlier download was interrupted
+        continues from the next_page_token of the last page that the most
+        recent run of the same request recorded in its files' page indexes,
+        and a shard whose most recent run finished is skipped. Rows are only
+        recorded in an index once they have been written, so no page is
+        lost; pages written after the last index update (e.g. if the process
+        was killed mid-flush) are downloaded and appended again. Only
+        supported for CSV files written with store_url and store_token.
         """
+        if resume and (format != "csv" or not (store_url and store_token)):
+            raise ValueError("resume=True requires format='csv', store_url=True and store_token=True")
+
         kwargs['limit'] = 10_000  # maximum limit per request is 10,000
-        self.paginate(
-            base=BARS_BASE_URL,
-            api_options=kwargs,
-            data_fmt=lambda body: {k:pd.DataFrame(v).assign(t=lambda df: pd.to_datetime(df['t'])) for k,v in body['bars'].items()},
-            write_path=write_path,
-            logfile_path=f"logs/bars_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.log",
-            log_fmt=lambda tables: "Wrote:\n\t- " + "\n\t- ".join(
-                f"{k}: {v.iloc[0]['t']} to {v.iloc[-1]['t']} ({len(v)} bars)" for k, v in tables.items()
-            ),
-            verbose=verbose,
-            store_url=store_url,
-            store_token=store_token,
-        )
+        if write_path is None:
+            write_path = f"bars/{{}}.{format}"
+
+        logfile_path = f"logs/bars_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.log"
+        AlpacaRequester.configure_logging(level=logging.INFO, logfile_path=logfile_path, to_console=verbose)
+        logger.info("Logging to %s", logfile_path)
+
+        # A page token belongs to one particular request, so it can't be
+        # split across shards
+        if 'symbols' in kwargs and 'page_token' not in kwargs:
+            symbols = self.split_symbols(kwargs['symbols'])
+            shards = [symbols[i:i+shard_size] for i in range(0, len(symbols), shard_size)] or [symbols]
+        else:
+            shards = [kwargs.get('symbols')]
+
+        def fetch(shard: Optional[List[str]]) -> None:
+            api_options = {**kwargs, 'symbols': shard} if shard is not None else dict(kwargs)
+            if resume and shard is not None and 'page_token' not in api_options:
+                # Bars come back sorted by symbol, so the last symbol with
+                # anything recorded holds the furthest page
+                token = self.resume_token(
+                    self.make_url(BARS_BASE_URL, **api_options),
+                    [f"{write_path.format(symbol)}.pages.csv" for symbol in sorted(shard)],
+                )
+                if token == "":
+                    logger.info("Bars for %s were already downloaded, skipping", ",".join(shard))
+                    return
+                if token is not None:
+                    logger.info("Resuming bars for %s from page token %s", ",".join(shard), token)
+                    api_options['page_token'] = token
+
+            self.paginate(
+                base=BARS_BASE_URL,
+                api_options=api_options,
+                data_fmt=lambda body: body['bars'],
+                write_path=write_path,
+                logfile_path=None,
+                log_fmt=lambda symbol, bars: f"Wrote {symbol}: {bars[0]['t']} to {bars[-1]['t']} ({len(bars)} bars)",
+                verbose=verbose,
+                store_url=store_url,
+                store_token=store_token,
+                desc="Fetching pages" if len(shards) == 1 else f"Fetching pages ({shard[0]}-{shard[-1]})",
+                format=format,
+                dtypes=BARS_DTYPES,
+                stream_key='bars',
+                use_uring=use_uring,
+                cancel=cancel,
+            )
+
+        # Shards that are already running can't be interrupted, so they are
+        # told to stop at their next page instead
+        cancel = threading.Event()
+        if len(shards) == 1:
+            fetch(shards[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+                futures = [executor.submit(fetch, shard) for shard in shards]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    cancel.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
 
         print("Wrote bars to files")
 
@@ -242,10 +1082,10 @@ class AlpacaRequester:
         self.paginate(
             base=NEWS_BASE_URL,
             api_options=kwargs,
-            data_fmt=lambda x: {'':pd.DataFrame(x['news'])},
+            data_fmt=lambda x: {'':x['news']},
             write_path=write_path,
             logfile_path=f"logs/news_{datetime.now().strftime('%Y-%m-%d_%H:%M:%S')}.log",
-            log_fmt=lambda tables: f"{len(tables[''])} articles written spanning {tables[''].iloc[-1]['created_at']} to {tables[''].iloc[0]['created_at']}",
+            log_fmt=lambda _, articles: f"{len(articles)} articles written spanning {articles[-1]['created_at']} to {articles[0]['created_at']}",
             verbose=verbose,
             store_url=store_url,
             store_token=store_token,
@@ -253,13 +1093,28 @@ class AlpacaRequester:
 
         print("Wrote news to files")
     
+    @staticmethod
+    def read_bars(path: str) -> pd.DataFrame:
+        """
+        Load a file written by get_bars with the bar columns already typed,
+        skipping pandas' dtype inference.
+        """
+        if str(path).endswith(".parquet"):
+            return pd.read_parquet(path)
+        df = pd.read_csv(path, dtype={k: v for k, v in BARS_DTYPES.items() if k != 't'})
+        df['t'] = pd.to_datetime(df['t'], format='ISO8601', utc=True).astype(BARS_DTYPES['t'])
+        return df
+
     def market_calendar(self,**kwargs) -> pd.DataFrame:
         """
         https://docs.alpaca.markets/reference/getcalendar-1
         """
         url = self.make_url(CALENDAR_BASE_URL, **kwargs)
-        response = requests.get(url, headers=self.headers)
-        data = response.json()
-        df = pd.DataFrame(data)
-        df['date'] = pd.to_datetime(df['date'])
-        return df
\ No newline at end of file
+        data = self._get_json(url, self.cache_ttl(kwargs))
+        if not data:
+            return pd.DataFrame()
+        # Build the frame column by column rather than row by row, and give
+        # the date format explicitly so pandas doesn't have to infer it
+        df = pd.DataFrame({k: [d.get(k) for d in data] for k in data[0]}, copy=False)
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d', cache=True)
+        return df
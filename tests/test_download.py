@@ -1,8 +1,60 @@
-from alpaca_api import AlpacaRequester
+from alpaca_api import AlpacaRequester, CachePolicy, TokenBucket
+from alpaca_api import download
+from alpaca_api.download import _CsvFile, _PagedOutput, _TeeReader, _Uring, _flush_outputs, _parse_streamed
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
+import csv
+import io
+import orjson
+import pandas as pd
 import pytest
 import os
+import time
+
+def write_index(path, *pages):
+    """
+    Write a page index holding the given pages, as dicts of INDEX_FIELDS.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_PagedOutput.INDEX_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(pages)
+
+class FakeResponse:
+    def __init__(self, status_code=200, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.raw = io.BytesIO(content or b"")
+        self.headers = headers or {}
+        self.closed = False
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FakeSession:
+    """
+    Stands in for requests.Session, answering each GET with respond(url).
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, stream=False):
+        self.requests.append(url)
+        return self.respond(url)
+
+    def close(self):
+        pass
 
 def test_get_account_info_from_env():
     X = AlpacaRequester()
@@ -41,6 +93,368 @@ def test_get_account_info_no_env():
 
     tmp_path.rename(old_path)
 
+def test_cache_ttl():
+    assert(AlpacaRequester.cache_ttl({'start': '2020-01-01', 'end': '2020-02-01'}) is None)
+    assert(AlpacaRequester.cache_ttl({'start': '2020-01-01'}) is not None)
+    assert(AlpacaRequester.cache_ttl({'end': '2999-01-01T00:00:00Z'}) is not None)
+
+def test_token_bucket():
+    bucket = TokenBucket(600, tokens=1)  # 10 tokens per second
+    assert(bucket.acquire() == 0)
+    waited = bucket.acquire()
+    assert(0 < waited <= 0.1)
+
+def test_make_url():
+    assert(AlpacaRequester.make_url("https://a.b/c") == "https://a.b/c")
+    assert(
+        AlpacaRequester.make_url("https://a.b/c", symbols=["AAPL", "BRK.B"], q="x&y=z")
+        == "https://a.b/c?q=x%26y%3Dz&symbols=AAPL%2CBRK.B"
+    )
+
+def test_split_symbols():
+    assert(AlpacaRequester.split_symbols("SPY") == ["SPY"])
+    assert(AlpacaRequester.split_symbols(["SPY,AAPL", " NVDA"]) == ["SPY", "AAPL", "NVDA"])
+    assert(AlpacaRequester.split_symbols(["SPY,AAPL", "SPY", "NVDA,AAPL"]) == ["SPY", "AAPL", "NVDA"])
+
+def test_read_bars(tmp_path):
+    path = tmp_path / "AAPL.csv"
+    path.write_text("t,o,h,l,c,v,n,vw\n2025-01-02T14:30:00Z,1.5,2,1,1.75,100,7,1.6\n")
+    df = AlpacaRequester.read_bars(str(path))
+    assert(str(df['t'].dtype) == 'datetime64[ns, UTC]')
+    assert(df['v'].dtype == 'int64' and df['h'].dtype == 'float64')
+
+def test_join_pages(tmp_path):
+    path = tmp_path / "AAPL.csv"
+    path.write_text("t,c\n1,1.0\n2,2.0\n3,3.0\n")
+    write_index(
+        tmp_path / "AAPL.csv.pages.csv",
+        {'page_idx': 0, 'url': 'u0', 'next_page_token': 'p1', 'start_row': 0, 'end_row': 2},
+        {'page_idx': 1, 'url': 'u1', 'next_page_token': '', 'start_row': 2, 'end_row': 3},
+    )
+    assert(AlpacaRequester.last_page(tmp_path / "AAPL.csv.pages.csv")['url'] == 'u1')
+    df = AlpacaRequester.join_pages(str(path))
+    assert(list(df['url']) == ['u0', 'u0', 'u1'])
+    assert(list(df['next_page_token']) == ['p1', 'p1', ''])
+
+def test_join_pages_legacy_columns(tmp_path):
+    # A file from before the page index, appended to since
+    path = tmp_path / "AAPL.csv"
+    path.write_text("t,c,url,next_page_token\n1,1.0,u0,p1\n2,2.0,u1,\n3,3.0,,\n")
+    write_index(
+        tmp_path / "AAPL.csv.pages.csv",
+        {'page_idx': 0, 'url': 'u2', 'next_page_token': '', 'start_row': 2, 'end_row': 3},
+    )
+    df = AlpacaRequester.join_pages(str(path))
+    assert(list(df.columns) == ['t', 'c', 'url', 'next_page_token'])
+    assert(list(df['url']) == ['u0', 'u1', 'u2'])
+    assert(list(df['next_page_token'].fillna('')) == ['p1', '', ''])
+
+def test_resume_token(tmp_path):
+    base_url = "https://a.b/bars?symbols=AAPL%2CMSFT"
+    aapl, msft, spy = (tmp_path / f"{s}.csv.pages.csv" for s in ("AAPL", "MSFT", "SPY"))
+    first, second = "2025-01-01T00:00:00+00:00", "2025-01-02T00:00:00+00:00"
+    aapl_pages = [
+        {'page_idx': 0, 'url': base_url, 'next_page_token': 'p1', 'start_row': 0, 'end_row': 2, 'run_started': first},
+        {'page_idx': 1, 'url': f"{base_url}&page_token=p1", 'next_page_token': 'p2', 'start_row': 2, 'end_row': 3, 'run_started': first},
+    ]
+    write_index(aapl, *aapl_pages)
+    write_index(msft)
+    write_index(spy, {'page_idx': 0, 'url': "https://a.b/bars?symbols=SPY", 'next_page_token': '', 'start_row': 0, 'end_row': 1, 'run_started': second})
+    assert(AlpacaRequester.last_page(msft) is None)
+    assert(AlpacaRequester.resume_token(base_url, [aapl, msft, spy]) == 'p2')
+    assert(AlpacaRequester.resume_token(base_url, [tmp_path / "missing.csv.pages.csv"]) is None)
+
+    write_index(msft, {'page_idx': 0, 'url': f"{base_url}&page_token=p2", 'next_page_token': '', 'start_row': 0, 'end_row': 1, 'run_started': first})
+    assert(AlpacaRequester.resume_token(base_url, [aapl, msft]) == '')
+
+    # A later run that only got as far as AAPL
+    write_index(aapl, *aapl_pages, {'page_idx': 2, 'url': base_url, 'next_page_token': 'p1', 'start_row': 3, 'end_row': 5, 'run_started': second})
+    assert(AlpacaRequester.resume_token(base_url, [aapl, msft]) == 'p1')
+
+def test_parse_streamed():
+    body = {
+        'bars': {
+            'AAPL': [{'t': "2025-01-01T00:00:00Z", 'c': 1.5, 'v': 10}],
+            'BRK.B': [{'t': "2025-01-01T00:00:00Z", 'c': 2.5, 'v': 20}, {'t': "2025-01-02T00:00:00Z", 'c': 3.0, 'v': 30}],
+        },
+        'next_page_token': "QlJLLkJ8MjAyNQ==",
+    }
+    content = orjson.dumps(body)
+    copy = io.BytesIO()
+    assert(_parse_streamed(_TeeReader(io.BytesIO(content), copy), 'bars') == body)
+    assert(copy.getvalue() == content)
+    assert(_parse_streamed(io.BytesIO(b'{"bars": {}, "next_page_token": null}'), 'bars') == {'bars': {}, 'next_page_token': None})
+    assert(_parse_streamed(io.BytesIO(b'{"next_page_token": "a\\"b", "bars": {}}'), 'bars')['next_page_token'] == 'a"b')
+    with pytest.raises(ValueError):
+        _parse_streamed(io.BytesIO(b'{"bars": {}}'), 'bars')
+
+def test_get_json_streamed(tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "STREAM_MIN_BYTES", 64)
+    url = "https://a.b/bars"
+    body = {'bars': {'BRK.B': [{'t': "2025-01-01T00:00:00Z", 'c': 1.5}] * 5}, 'next_page_token': None}
+    content = orjson.dumps(body)
+    response = FakeResponse(content=content, headers={'Content-Length': str(len(content))})
+    response.content = None  # large responses are only read through the raw stream
+
+    X = AlpacaRequester(api_key='a', api_secret='b', cache_dir=tmp_path, cache_policy=CachePolicy.ENABLED)
+    X.session = FakeSession(lambda url: response)
+    assert(X._get_json(url, None, 'bars') == body)
+    assert(response.closed)
+    assert(X._cache_path(url).read_bytes() == content)
+
+def test_csv_file_header(tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "WRITE_CHUNK_SIZE", 16)
+    path = tmp_path / "new" / "AAPL.csv"
+    f = _CsvFile(path)
+    f.write([{'t': 0, 'c': 0.5}] + [{'t': i, 'c': 1.5, 'n': i} for i in range(1, 100)])
+    f.close()
+    lines = path.read_text().splitlines()
+    assert(lines[:3] == ["t,c,n", "0,0.5,", "1,1.5,1"])
+    assert(len(lines) == 101)
+
+    # Rows appended to an existing file follow its header, including the
+    # url/next_page_token columns of files written before the page index
+    path = tmp_path / "MSFT.csv"
+    path.write_text("c,t,url,next_page_token\n1.0,1,u0,p1\n")
+    f = _CsvFile(path)
+    f.write([{'t': 2, 'c': 2.0}])
+    f.close()
+    assert(path.read_text() == "c,t,url,next_page_token\n1.0,1,u0,p1\n2.0,2,,\n")
+
+def test_paged_output_flush(tmp_path):
+    path = tmp_path / "AAPL.csv"
+    out = _PagedOutput(path, "csv", None)
+    out.add_page([{'t': 1}, {'t': 2}], "u0", "p1")
+    out.add_page([{'t': 3}], "u1", None)
+    assert(path.read_text() == "")
+    out.flush()
+    out.close()
+    assert(path.read_text() == "t\n1\n2\n3\n")
+    assert(AlpacaRequester.last_page(f"{path}.pages.csv") == {
+        'page_idx': '1', 'url': 'u1', 'next_page_token': '', 'start_row': '2', 'end_row': '3',
+        'run_started': out.run_started, 'end_offset': '8',
+    })
+
+    # Reopening continues the row and page numbering
+    out = _PagedOutput(path, "csv", None)
+    assert((out.next_page_idx, out.num_rows) == (2, 3))
+    out.close()
+
+def test_paged_output_unrecorded_rows(tmp_path):
+    # A run that died after writing its rows but before recording their page
+    path = tmp_path / "AAPL.csv"
+    path.write_text('t,c\n1,1.0\n2,2.0\n3,"3.0"\n')
+    write_index(
+        tmp_path / "AAPL.csv.pages.csv",
+        {'page_idx': 0, 'url': 'u0', 'next_page_token': 'p1', 'start_row': 0, 'end_row': 2, 'end_offset': 16},
+    )
+    assert(download._count_rows(path, 16) == 1)
+
+    out = _PagedOutput(path, "csv", None)
+    assert(out.num_rows == 3)
+    out.add_page([{'t': 4, 'c': 4.0}], "u2", None)
+    out.flush()
+    out.close()
+    assert(AlpacaRequester.last_page(tmp_path / "AAPL.csv.pages.csv")['start_row'] == '3')
+    df = AlpacaRequester.join_pages(str(path))
+    assert(list(df['t']) == [1, 2, 3, 4])
+    assert(list(df['url'].fillna('')) == ['u0', 'u0', '', 'u2'])
+
+def test_uring_write_all(tmp_path):
+    ring = _Uring.create()
+    if ring is None:
+        pytest.skip("io_uring is not available")
+    try:
+        fds = [os.open(tmp_path / f"{i}.txt", os.O_WRONLY | os.O_CREAT | os.O_APPEND) for i in range(3)]
+        ring.write_all([(fd, f"{i}\n".encode() * 1000) for i, fd in enumerate(fds)])
+        ring.write_all([(fds[0], b"end\n"), (fds[1], b"")])
+        for fd in fds:
+            os.close(fd)
+
+        # Outputs flushed through the ring end up the same as regular writes
+        outputs = [_PagedOutput(tmp_path / f"{s}.csv", "csv", None) for s in ("AAPL", "MSFT")]
+        for out in outputs:
+            out.add_page([{'t': 1}, {'t': 2}], "u0", None)
+        _flush_outputs(outputs, ring)
+        for out in outputs:
+            out.close()
+    finally:
+        ring.close()
+    assert((tmp_path / "0.txt").read_text() == "0\n" * 1000 + "end\n")
+    assert((tmp_path / "1.txt").read_text() == "1\n" * 1000)
+    assert((tmp_path / "MSFT.csv").read_text() == "t\n1\n2\n")
+    assert(AlpacaRequester.last_page(tmp_path / "MSFT.csv.pages.csv")['end_row'] == '2')
+
+def test_response_cache(tmp_path):
+    url = "https://a.b/c"
+    def requester(policy, response):
+        X = AlpacaRequester(api_key='a', api_secret='b', cache_dir=tmp_path, cache_policy=policy)
+        X.session = FakeSession(lambda url: response)
+        return X
+
+    X = requester(CachePolicy.READ_ONLY, FakeResponse(content=b'{"n": 1}'))
+    assert(X._get_json(url, None) == {'n': 1})
+    assert(not any(tmp_path.rglob("*.json")))
+    with pytest.raises(ValueError):
+        requester(CachePolicy.REPLAY, FakeResponse())._get_json(url, None)
+
+    # A response that fails while it is being cached leaves nothing behind
+    X = requester(CachePolicy.ENABLED, FakeResponse(content=None))
+    with pytest.raises(TypeError):
+        X._get_json(url, None)
+    assert(not any(tmp_path.rglob("*.*")))
+
+    X = requester(CachePolicy.ENABLED, FakeResponse(content=b'{"n": 1}'))
+    assert(X._get_json(url, None) == {'n': 1})
+    assert(X._get_json(url, None) == {'n': 1})
+    assert(len(X.session.requests) == 1)
+    assert([p.suffix for p in tmp_path.rglob("*.*")] == [".json"])
+
+    X = requester(CachePolicy.REPLAY, FakeResponse(status_code=500))
+    assert(X._get_json(url, None) == {'n': 1})
+    assert(X.session.requests == [])
+
+    # Expired entries are still served when the API fails
+    response = FakeResponse(status_code=503)
+    X = requester(CachePolicy.ENABLED, response)
+    assert(X._get_json(url, -1) == {'n': 1})
+    assert(response.closed)
+
+def test_error_response_closed():
+    response = FakeResponse(status_code=403)
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(lambda url: response)
+    with pytest.raises(ValueError):
+        X._get_json("https://a.b/c")
+    assert(response.closed)
+
+def test_flush_budget_across_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download, "FLUSH_ROWS", 2)
+    written = []
+    def respond(url):
+        page = int(url.rsplit("page_token=", 1)[-1]) if "page_token=" in url else 0
+        if page == 2:
+            # Page 0 has been handled by the time page 2 is requested
+            written.append(Path("bars/AAPL.csv").read_text())
+        return FakeResponse(content=orjson.dumps({
+            'bars': {s: [{'t': page}] for s in ("AAPL", "MSFT")},
+            'next_page_token': str(page + 1) if page < 3 else None,
+        }))
+
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(respond)
+    X.get_bars(symbols="AAPL,MSFT", timeframe="1D")
+    # One row per file per page, but two rows buffered in total
+    assert(written[0].startswith("t\n0\n"))
+    assert(pd.read_csv("bars/MSFT.csv")['t'].tolist() == [0, 1, 2, 3])
+
+def test_get_bars_stops_on_error(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    def respond(url):
+        if "symbols=AAPL" in url:
+            return FakeResponse(status_code=403)
+        time.sleep(0.01)
+        page = int(url.rsplit("page_token=", 1)[-1]) if "page_token=" in url else 0
+        return FakeResponse(content=orjson.dumps({
+            'bars': {'MSFT': [{'t': f"2025-01-01T00:{page // 60:02}:{page % 60:02}Z", 'c': 1.0}]},
+            'next_page_token': str(page + 1) if page < 500 else None,
+        }))
+
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(respond)
+    with pytest.raises(ValueError):
+        X.get_bars(symbols="AAPL,MSFT", shard_size=1, timeframe="1Min")
+    assert(len(X.session.requests) < 100)
+
+def test_resume_after_failed_rerun(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pages = [
+        {'AAPL': [{'t': 1}, {'t': 2}]},
+        {'AAPL': [{'t': 3}], 'MSFT': [{'t': 1}]},
+        {'MSFT': [{'t': 2}, {'t': 3}]},
+    ]
+    fail = False
+    def respond(url):
+        page = int(url.rsplit("page_token=", 1)[-1]) if "page_token=" in url else 0
+        if fail and page > 0:
+            return FakeResponse(status_code=500)
+        return FakeResponse(content=orjson.dumps({
+            'bars': pages[page],
+            'next_page_token': str(page + 1) if page + 1 < len(pages) else None,
+        }))
+
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(respond)
+    X.get_bars(symbols="AAPL,MSFT", timeframe="1D")
+
+    # A rerun of the same request that dies after its first page, so that
+    # MSFT's index still ends with the first run's final page
+    fail = True
+    with pytest.raises(ValueError):
+        X.get_bars(symbols="AAPL,MSFT", timeframe="1D")
+    assert(len(pd.read_csv("bars/AAPL.csv")) == 5)
+
+    fail = False
+    X.session.requests.clear()
+    X.get_bars(symbols="AAPL,MSFT", timeframe="1D", resume=True)
+    assert(len(X.session.requests) == 2)
+    assert(list(pd.read_csv("bars/AAPL.csv")['t']) == [1, 2, 3, 1, 2, 3])
+    assert(list(pd.read_csv("bars/MSFT.csv")['t']) == [1, 2, 3, 1, 2, 3])
+
+    X.session.requests.clear()
+    X.get_bars(symbols="AAPL,MSFT", timeframe="1D", resume=True)
+    assert(X.session.requests == [])
+
+def test_market_calendar():
+    days = [
+        {'date': "2025-01-02", 'open': "09:30", 'close': "16:00", 'session_open': "0400", 'session_close': "2000", 'settlement_date': "2025-01-03"},
+        {'date': "2025-01-03", 'open': "09:30", 'close': "16:00", 'session_open': "0400", 'session_close': "2000", 'settlement_date': "2025-01-06"},
+    ]
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(lambda url: FakeResponse(content=orjson.dumps(days)))
+    df = X.market_calendar(start="2025-01-01", end="2025-01-05")
+    assert(list(df.columns) == list(days[0]))
+    assert(df['date'].tolist() == [pd.Timestamp("2025-01-02"), pd.Timestamp("2025-01-03")])
+    assert(df['close'].tolist() == ["16:00", "16:00"])
+
+    X.session = FakeSession(lambda url: FakeResponse(content=b"[]"))
+    assert(X.market_calendar(start="2025-01-04", end="2025-01-05").empty)
+
+def test_get_bars_parquet(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.chdir(tmp_path)
+    bars = [
+        {'t': f"2025-01-0{i}T14:30:00Z", 'o': 1.0, 'h': 2.0, 'l': 0.5, 'c': 1.5, 'v': 100 * i, 'n': i, 'vw': 1.2}
+        for i in range(1, 4)
+    ]
+    fail = False
+    def respond(url):
+        page = int(url.rsplit("page_token=", 1)[-1]) if "page_token=" in url else 0
+        if fail and page > 0:
+            return FakeResponse(status_code=403)
+        return FakeResponse(content=orjson.dumps({
+            'bars': {'AAPL': [bars[page]]},
+            'next_page_token': str(page + 1) if page < 2 else None,
+        }))
+
+    X = AlpacaRequester(api_key='a', api_secret='b')
+    X.session = FakeSession(respond)
+    X.get_bars(symbols="AAPL", timeframe="1D", format="parquet")
+    df = AlpacaRequester.read_bars("bars/AAPL.parquet")
+    assert(df.dtypes.astype(str).to_dict() == download.BARS_DTYPES)
+    assert(df['v'].tolist() == [100, 200, 300])
+    assert(df['t'].iloc[0] == pd.Timestamp("2025-01-01T14:30:00Z"))
+    assert(len(AlpacaRequester.join_pages("bars/AAPL.parquet")) == 3)
+
+    # A failed rerun leaves the previous file and its index in place
+    fail = True
+    with pytest.raises(ValueError):
+        X.get_bars(symbols="AAPL", timeframe="1D", format="parquet")
+    assert(AlpacaRequester.read_bars("bars/AAPL.parquet")['v'].tolist() == [100, 200, 300])
+    assert(AlpacaRequester.last_page("bars/AAPL.parquet.pages.csv")['page_idx'] == '2')
+    assert(sorted(p.name for p in Path("bars").iterdir()) == ["AAPL.parquet", "AAPL.parquet.pages.csv"])
+
 def test_get_bars():
     """
     Downloads data from URL until no pages left.